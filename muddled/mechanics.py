@@ -30,6 +30,15 @@ class ErrorInBuildDescription(GiveUp):
 
 build_name_re = re.compile(r"[A-Za-z0-9_-]+")
 
+# The directory types for those top-level directories in a build tree where
+# we can't work out a label from the rest of the path. Note that "domains"
+# is here because inside it we are actually at a (subdomain) root.
+top_level_dir_types = {
+        'domains'  : utils.DirType.DomainRoot,
+        '.muddle'  : utils.DirType.MuddleDir,
+        'versions' : utils.DirType.Versions,
+        }
+
 def check_build_name(name):
     """Check a build name for legality.
 
@@ -149,6 +158,12 @@ class Builder(object):
         # It's useful to know our build description's label
         self.build_desc_label = None
 
+        # The rules that the current call of build_label (or
+        # build_label_with_options) is working through, in order. Actions
+        # can use this to see what else this command is going to build.
+        # It is empty when we are not building anything.
+        self.rules_being_built = []
+
         # The current distribution name and target directory, as a tuple,
         # or actually None, since we've not set it yet
         # directory with each...
@@ -725,25 +740,30 @@ class Builder(object):
             print "There is no rule to build label %s"%label
             return
 
-        for r in rule_list:
-            if self.db.is_tag(r.target):
-                # Don't build stuff that's already built ..
-                pass
-            else:
-                if not silent:
-                    print "> Building %s"%(r.target)
+        outer_rules = self.rules_being_built
+        self.rules_being_built = rule_list
+        try:
+            for r in rule_list:
+                if self.db.is_tag(r.target):
+                    # Don't build stuff that's already built ..
+                    pass
+                else:
+                    if not silent:
+                        print "> Building %s"%(r.target)
 
-                # Set up the environment for building this label
-                old_env = os.environ.copy()
-                try:
-                    self._build_label_env(r.target, env_store)
+                    # Set up the environment for building this label
+                    old_env = os.environ.copy()
+                    try:
+                        self._build_label_env(r.target, env_store)
 
-                    if r.action:
-                        r.action.build_label(self, r.target)
-                finally:
-                    os.environ = old_env
+                        if r.action:
+                            r.action.build_label(self, r.target)
+                    finally:
+                        os.environ = old_env
 
-                self.db.set_tag(r.target)
+                    self.db.set_tag(r.target)
+        finally:
+            self.rules_being_built = outer_rules
 
     def build_label_with_options(self, label, useDepends = True, useTags = True, silent = False):
         """
@@ -763,24 +783,29 @@ class Builder(object):
             print "There is no rule to build label %s"%label
             return
 
-        for r in rule_list:
-            # Build it.
-            if (not self.db.is_tag(r.target)):
-                # Don't build stuff that's already built ..
-                if (not silent):
-                    print "> Building %s"%(r.target)
-
-                # Set up the environment for building this label
-                old_env = os.environ.copy()
-                try:
-                    self._build_label_env(r.target, env_store)
-
-                    if r.action:
-                        r.action.build_label(self, r.target)
-                finally:
-                    os.environ = old_env
-
-                self.db.set_tag(r.target)
+        outer_rules = self.rules_being_built
+        self.rules_being_built = rule_list
+        try:
+            for r in rule_list:
+                # Build it.
+                if (not self.db.is_tag(r.target)):
+                    # Don't build stuff that's already built ..
+                    if (not silent):
+                        print "> Building %s"%(r.target)
+
+                    # Set up the environment for building this label
+                    old_env = os.environ.copy()
+                    try:
+                        self._build_label_env(r.target, env_store)
+
+                        if r.action:
+                            r.action.build_label(self, r.target)
+                    finally:
+                        os.environ = old_env
+
+                    self.db.set_tag(r.target)
+        finally:
+            self.rules_being_built = outer_rules
 
     @property
     def build_name(self):
@@ -962,12 +987,8 @@ class Builder(object):
             our_root = root_dir
 
         # Dir is (hopefully) a bit like
-        # root / X , so we walk up it  ...
-        rest = []
-        while dir != our_root:
-            base, cur = os.path.split(dir)
-            rest.insert(0, cur)
-            dir = base
+        # root / X , so we split up what comes after the root
+        rest = os.path.relpath(dir, our_root).split(os.sep)
 
         result = None
 
@@ -1021,18 +1042,10 @@ class Builder(object):
                 label = None
             result = (utils.DirType.Deployed, label, domain_name)
 
-        elif rest[0] == "domains":
-            # We're inside the current domain - this is actually a root
-            result = (utils.DirType.DomainRoot, None, domain_name)
-
-        elif rest[0] == '.muddle':
-            result = (utils.DirType.MuddleDir, None, domain_name)
-
-        elif rest[0] == 'versions':
-            result = (utils.DirType.Versions, None, domain_name)
-
         else:
-            result = (utils.DirType.Unexpected, None, domain_name)
+            # Anywhere else, the top-level directory tells us all we know
+            what = top_level_dir_types.get(rest[0], utils.DirType.Unexpected)
+            result = (what, None, domain_name)
 
         return result
 
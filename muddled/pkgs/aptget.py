@@ -3,13 +3,151 @@ An apt-get package. When you try to build it, this package
 pulls in a pre-canned set of packages via apt-get.
 """
 
+from __future__ import print_function
+
+import os
+import re
 import subprocess
 
 import muddled.pkg as pkg
 import muddled.depend as depend
 
-from muddled.utils import GiveUp, LabelTag, LabelType
-from muddled.utils import run2, Choice, get_os_version_name
+from muddled.utils import GiveUp, ShellError, LabelTag, LabelType
+from muddled.utils import get_cmd_data, Choice, get_os_version_name
+
+# dpkg's status file, which changes whenever packages are installed or removed
+DPKG_STATUS_FILE = '/var/lib/dpkg/status'
+
+# Changed whenever what we remember in our cache of installed packages changes,
+# so that we don't trust a cache written by an older muddle
+_INSTALLED_CACHE_VERSION = 2
+
+# The label type and tags we use, so we only have to look them up once
+_TYPE_PKG = LabelType.Package
+_TAG_PRECONFIG = LabelTag.PreConfig
+_TAG_BUILT = LabelTag.Built
+_TAG_POSTINSTALLED = LabelTag.PostInstalled
+
+g_installed_packages = None
+
+# Matches a line of dpkg-query output, if the second character of the status
+# abbreviation says the package is installed, giving us the package name, its
+# "binary" name (which is qualified with its architecture if it is a multiarch
+# package) and its architecture
+g_installed_re = re.compile(r'^.i\S*[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)',
+                            re.MULTILINE)
+
+def _query_installed_packages():
+    """
+    Ask dpkg-query for the set of names of installed debian packages.
+
+    We ask for all of the packages it knows about::
+
+        $ dpkg-query -W -f='${db:Status-Abbrev} ${Package} ${binary:Package} ${Architecture}\\n'
+        ii  adduser adduser all
+        un  apt-doc apt-doc
+        ii  apt-utils apt-utils amd64
+        ii  libc6 libc6:amd64 amd64
+        ii  libc6 libc6:i386 i386
+        ...
+
+    The second character of the status abbreviation is the current state of
+    the package, which is 'i' if it is installed.
+
+    Each installed package is added to the set both by its bare name and
+    qualified by its architecture (e.g., 'libc6' and 'libc6:i386'), so that
+    multiarch names in 'pkgs_to_install' can be found as well.
+    """
+    try:
+        stdout = get_cmd_data([ "dpkg-query", "-W",
+                                "-f=${db:Status-Abbrev} ${Package}"
+                                " ${binary:Package} ${Architecture}\\n" ])
+    except (ShellError, OSError):
+        # Either dpkg-query failed, or it isn't there at all (in which case
+        # get_cmd_data gives us an OSError). Either way, assume nothing is
+        # installed, and let apt-get sort it out
+        stdout = ''
+    installed = set()
+    for name, binary_name, arch in g_installed_re.findall(stdout):
+        installed.add(name)
+        installed.add(binary_name)
+        installed.add('%s:%s'%(name, arch))
+    return installed
+
+def _dpkg_status_key():
+    """
+    Return a string identifying the current state of dpkg's status file.
+
+    Returns None if we can't find the status file. The string also includes
+    the version of our cache format.
+    """
+    try:
+        st = os.stat(DPKG_STATUS_FILE)
+    except OSError:
+        return None
+    return '%d %r %d'%(_INSTALLED_CACHE_VERSION, st.st_mtime, st.st_size)
+
+def _read_installed_cache(cache_file, key):
+    """
+    Return the set of installed packages remembered in 'cache_file'.
+
+    Returns None if there is no such file, or if it was written for a
+    different 'key' (i.e., when dpkg's status file was different).
+    """
+    try:
+        with open(cache_file) as fd:
+            lines = fd.read().splitlines()
+    except IOError:
+        return None
+    if not lines or lines[0] != key:
+        return None
+    return set(lines[1:])
+
+def _write_installed_cache(cache_file, key, installed):
+    """
+    Remember the set of 'installed' packages in 'cache_file'.
+    """
+    working_file = '%s.new'%cache_file
+    try:
+        with open(working_file, 'w') as fd:
+            fd.write('%s\n'%key)
+            for name in sorted(installed):
+                fd.write('%s\n'%name)
+        os.rename(working_file, cache_file)
+    except (IOError, OSError):
+        # It's only a cache, so it doesn't matter if we can't write it
+        pass
+
+def installed_packages(builder=None):
+    """
+    Return the set of names of the debian packages that are installed.
+
+    The first time we're called, we ask dpkg-query which packages are
+    installed. After that, we just return the set we remembered. We assume
+    that nothing other than ourselves is going to install or remove packages
+    while muddle is running.
+
+    If 'builder' is given, then the set is also remembered in the build's
+    .muddle directory, along with the modification time and size of
+    DPKG_STATUS_FILE. Later muddle commands use that instead of running
+    dpkg-query, until dpkg's status file changes.
+    """
+    global g_installed_packages
+
+    if (g_installed_packages is None):
+        cache_file = None
+        key = None
+        if builder is not None:
+            cache_file = builder.db.db_file_name('_aptget_installed')
+            key = _dpkg_status_key()
+        if key is not None:
+            g_installed_packages = _read_installed_cache(cache_file, key)
+        if g_installed_packages is None:
+            g_installed_packages = _query_installed_packages()
+            if key is not None:
+                _write_installed_cache(cache_file, key, g_installed_packages)
+
+    return g_installed_packages
 
 
 class AptGetBuilder(pkg.PackageBuilder):
@@ -18,6 +156,9 @@ class AptGetBuilder(pkg.PackageBuilder):
 
     The "build" action for AptGetBuilder uses the Debian tool apt-get
     to ensure that each package is installed.
+
+    apt-get is run without asking for confirmation, and without installing
+    recommended packages - if you need any of those, name them explicitly.
     """
 
     def __init__(self, name, role,  pkgs_to_install, os_version=None):
@@ -48,6 +189,9 @@ class AptGetBuilder(pkg.PackageBuilder):
 
         We also allow a single string, or a single Choice, treated as if they
         were wrapped in a list.
+
+        If the same package is named more than once, it is only remembered
+        the first time.
         """
         super(AptGetBuilder, self).__init__(name, role)
 
@@ -77,63 +221,100 @@ class AptGetBuilder(pkg.PackageBuilder):
                 else:
                     raise GiveUp('%r is not a string or a Choice'%pkg)
 
-        self.pkgs_to_install = actual_packages
+        # Only remember each package once, but keep them in the order given
+        self.pkgs_to_install = []
+        seen = set()
+        for pkg in actual_packages:
+            if pkg not in seen:
+                seen.add(pkg)
+                self.pkgs_to_install.append(pkg)
 
     def already_installed(self, pkg):
         """
         Decide if the quoted debian package is already installed.
-
-        We use dpkg-query::
-
-            $ dpkg-query -W -f=\${Status}\\n libreadline-dev
-            install ok installed
-
-        That third word means what it says (installed). Contrast with a package
-        that is either not recognised or has not been downloaded at all::
-
-            $ dpkg-query -W -f=\${Status}\\n a0d
-            dpkg-query: no packages found matching a0d
-
-        So we do some fairly simple processing of the output...
         """
-        retval, stdout = run2([ "dpkg-query", "-W", "-f=\${Status}\\n'", pkg ],
-                                    show_command=False)
-        if retval:
-            # Assume it's not installed
-            return False
-
-        lines = stdout.splitlines()
-        if len(lines) == 0:
-            return False
-
-        words = lines[0].split()
-        if len(words) == 3 and words[2] == 'installed':
-            return True
-        else:
-            return False
-
+        return pkg in installed_packages()
 
     def build_label(self, builder, label):
         """
         This time, build is the only one we care about.
         """
 
-        if (label.tag == LabelTag.Built):
-            need_to_install = [ ]
+        if (label.tag == _TAG_BUILT):
+            if not self.pkgs_to_install:
+                return
+
+            # Make sure we know what is installed, using our cache if we can
+            if installed_packages(builder).issuperset(self.pkgs_to_install):
+                # Nothing to do
+                return
+
+            # Each run of apt-get has to read the package lists and resolve
+            # dependencies all over again, so since we have to run it anyway,
+            # install everything that the other (not yet built) apt-get
+            # packages that this command is building want at the same time
+            our_packages = [ p for p in self.pkgs_to_install
+                             if not self.already_installed(p) ]
+            need_to_install = [ p for p in wanted_packages(builder, self)
+                                if not self.already_installed(p) ]
+
+            if not _apt_get_install(need_to_install):
+                # Don't let one of the other packages stop us installing ours
+                if len(need_to_install) == len(our_packages):
+                    raise GiveUp("Couldn't install required packages")
+                print("Couldn't install all the packages at once,"
+                      " trying just those for %s"%label)
+                need_to_install = our_packages
+                if not _apt_get_install(need_to_install):
+                    raise GiveUp("Couldn't install required packages")
+            installed_packages().update(need_to_install)
 
-            for cur_pkg in self.pkgs_to_install:
-                if (not self.already_installed(cur_pkg)):
-                    need_to_install.append(cur_pkg)
+            print(">> Installed %s"%(" ".join(self.pkgs_to_install)))
 
-            if (len(need_to_install) > 0):
-                cmd_list = [ "sudo", "apt-get", "install" ]
-                cmd_list.extend(need_to_install)
-                print "> %s"%(" ".join(cmd_list))
-                rv = subprocess.call(cmd_list)
-                if rv != 0:
-                    raise GiveUp("Couldn't install required packages")
 
-            print ">> Installed %s"%(" ".join(self.pkgs_to_install))
+def _apt_get_install(pkgs):
+    """
+    Use apt-get to install the named debian packages.
+
+    Returns True if apt-get succeeds, False if it fails.
+    """
+    cmd_list = [ "sudo", "apt-get", "install", "-y",
+                 "--no-install-recommends",
+                 "-o", "Dpkg::Use-Pty=0",
+                 "-o", "Acquire::Retries=3" ]
+    cmd_list.extend(pkgs)
+    print("> %s"%(" ".join(cmd_list)))
+    return subprocess.call(cmd_list) == 0
+
+def wanted_packages(builder, first=None):
+    """
+    Return the debian packages wanted by the apt-get packages being built.
+
+    Only AptGetBuilders whose "built" label is among those that the builder
+    is currently building (builder.rules_being_built), and has not yet been
+    built, are considered. If 'first' is given, it is the AptGetBuilder whose
+    packages should come first in the result.
+
+    Each package name occurs only once in the list returned.
+    """
+    actions = []
+    if first is not None:
+        actions.append(first)
+    for rule in builder.rules_being_built:
+        if (isinstance(rule.action, AptGetBuilder) and
+            rule.action not in actions and
+            rule.target.tag == _TAG_BUILT and
+            not builder.db.is_tag(rule.target)):
+            actions.append(rule.action)
+
+    wanted = []
+    seen = set()
+    for action in actions:
+        for p in action.pkgs_to_install:
+            if p not in seen:
+                seen.add(p)
+                wanted.append(p)
+    return wanted
 
 
 def simple(builder, name, role, apt_pkgs, os_version=None):
@@ -182,15 +363,22 @@ def depends_on_aptget(builder, name, role, pkg, pkg_role):
       add here ..
     """
 
-    tgt_label = depend.Label(LabelType.Package,
+    _depends_on(builder,
+                depend.Label(_TYPE_PKG, name, role, _TAG_POSTINSTALLED),
+                pkg, pkg_role)
+
+
+def _depends_on(builder, src_label, pkg, pkg_role):
+    """
+    Make the "preconfig" label for 'pkg' in 'pkg_role' depend on 'src_label'.
+    """
+    tgt_label = depend.Label(_TYPE_PKG,
                              pkg,  pkg_role,
-                             LabelTag.PreConfig)
+                             _TAG_PRECONFIG)
 
     the_rule = builder.ruleset.rule_for_target(tgt_label,
                                                createIfNotPresent = True)
-    the_rule.add(depend.Label(LabelType.Package,
-                              name, role,
-                              LabelTag.PostInstalled))
+    the_rule.add(src_label)
 
 
 def medium(builder, name, role, apt_pkgs, roles, os_version=None):
@@ -202,8 +390,10 @@ def medium(builder, name, role, apt_pkgs, roles, os_version=None):
     the documentation for AptGetBuilder.
     """
     simple(builder, name, role, apt_pkgs, os_version=None)
+    # Every role depends on the same label, so we only need to make it once
+    src_label = depend.Label(_TYPE_PKG, name, role, _TAG_POSTINSTALLED)
     for dep_role in roles:
-        depends_on_aptget(builder, name, role, "*", dep_role)
+        _depends_on(builder, src_label, "*", dep_role)
 
 
 
@@ -5,6 +5,7 @@ Muddle utilities.
 import errno
 import hashlib
 import imp
+import mmap
 import os
 import pipes
 import pwd
@@ -207,24 +208,6 @@ for key, value in DirTypeDict.items():
 
 DirType = __directory_type_type(**DirTypeDict)
 
-def string_cmp(a,b):
-    """
-    Return -1 if a < b, 0 if a == b,  +1 if a > b.
-    """
-    if (a is None) and (b is None):
-        return 0
-    if (a is None):
-        return -1
-    if (b is None):
-        return 1
-
-    if (a < b):
-        return -1
-    elif (a==b):
-        return 0
-    else:
-        return 1
-
 # Total ordering class decorator.
 # From http://code.activestate.com/recipes/576685/
 # By Raymond Hettinger
@@ -350,11 +333,15 @@ def find_domain(root_dir, dir):
 
                 if domain_dir is None:
                     domain_dir = dir
+
+                # We know our parent is a "domains" directory, which will
+                # not contain a ".muddle", so we can skip it
+                dir = os.path.dirname(dir)
             else:
                 raise GiveUp("Directory '%s' contains a '.muddle' directory,\n"
                         "and is within the build tree at '%s'\n"
                         "but is marked as a subdomain"%(dir, root_dir))
-        dir, tail = os.path.split(dir)
+        dir = os.path.dirname(dir)
 
     return (domain_name, domain_dir)
 
@@ -403,11 +390,15 @@ def find_root_and_domain(dir):
                     current_domain = new_domain
                 else:
                     current_domain = "%s(%s)"%(new_domain,current_domain)
+
+                # We know our parent is a "domains" directory, which will
+                # not contain a ".muddle", so we can skip it
+                dir = os.path.dirname(dir)
             else:
                 return (dir, current_domain)
 
-        up1, basename = os.path.split(dir)
-        if up1 == dir or dir == '/':    # We're done
+        up1 = os.path.dirname(dir)
+        if up1 == dir:                  # We're done
             break
 
         dir = up1
@@ -458,8 +449,8 @@ def find_local_root(builder, label):
         if os.path.exists(os.path.join(dir, '.muddle')):
             return dir
 
-        up1, tail = os.path.split(dir)
-        if up1 == dir or dir == '/':
+        up1 = os.path.dirname(dir)
+        if up1 == dir:
             # We treat this as a bug because we assume we wouldn't BE here
             # unless we already knew (or rather, one of our callers did) that
             # we were "inside" a muddle build tree
@@ -508,18 +499,28 @@ def ensure_dir(dir, verbose=True):
     else:
         if verbose:
             print "> Make directory %s"%dir
-        os.makedirs(dir)
+        try:
+            os.makedirs(dir)
+        except OSError as e:
+            # Someone else may have created it since we looked
+            if e.errno != errno.EEXIST:
+                raise
+            if not os.path.isdir(dir):
+                raise MuddleBug("%s exists but is not a directory"%dir)
 
 def pad_to(str, val, pad_with = " "):
     """
     Pad the given string to the given number of characters with the given string.
+
+        >>> pad_to('abc', 6, '.')
+        'abc...'
+        >>> pad_to('abcdef', 3)
+        'abcdef'
     """
-    to_pad = (val - len(str)) / len(pad_with)
-    arr =  [ str ]
-    for i in range(0, to_pad):
-        arr.append(pad_with)
+    to_pad = (val - len(str)) // len(pad_with)
+    return str + pad_with * max(0, to_pad)
 
-    return "".join(arr)
+_vcs_url_re = re.compile("^([A-Za-z]+)\+([A-Za-z+]+):(.*)$")
 
 def split_vcs_url(url):
     """
@@ -527,9 +528,7 @@ def split_vcs_url(url):
     specifier, return (None, None).
     """
 
-    the_re = re.compile("^([A-Za-z]+)\+([A-Za-z+]+):(.*)$")
-
-    m = the_re.match(url)
+    m = _vcs_url_re.match(url)
     if (m is None):
         return (None, None)
 
@@ -620,15 +619,34 @@ def _rationalise_cmd(thing):
     return thing
 
 
+def _prepare_cmd(thing, env, show_command):
+    """Do the common preparation for get_cmd_data() and the runX functions.
+
+    Returns the command as a sequence (see _rationalise_cmd), and the
+    environment to run it in - 'env' itself, or 'os.environ' if that is None.
+
+    If 'show_command' is true, reports the command as "> <thing>".
+    """
+    thing = _rationalise_cmd(thing)
+    if show_command:
+        sys.stdout.write('> %s\n'%_stringify_cmd(thing))
+        sys.stdout.flush()
+    if env is None: # so, for instance, an empty dictionary is allowed
+        env = os.environ
+    return thing, env
+
 def shell(thing, env=None, show_command=True):
     """Run the command 'thing' in the shell.
 
     If 'thing' is a string (e.g., "ls -l"), then it will be used as it is
     given.
 
-    If 'thing' is a sequence (e.g., ["ls", "-l"]), then each component will
-    be escaped with pipes.quote(), and the result concatenated (with spaces
-    between) to give the command line to run.
+    If 'thing' is a sequence (e.g., ["ls", "-l"]), then it is run directly,
+    without using the shell - there is nothing for the shell to do, since
+    we would otherwise have had to escape each component with pipes.quote().
+    Any non-string items in the sequence will be converted to strings using
+    'str()'. When reporting the command, each component is escaped with
+    pipes.quote(), and the result concatenated (with spaces between).
 
     If 'env' is given, then it is the environment to use when running 'thing',
     otherwise 'os.environ' is used.
@@ -642,11 +660,12 @@ def shell(thing, env=None, show_command=True):
     be raised, containing the returncode, the command string and any output
     that occurred.
 
-    Unlike the various 'runX' functions, this calls subprocess.Popen with
-    'shell=True'. This makes things like "cd" available in 'thing', and use of
-    shell specific things like value expansion. It also, morei mportantly for
-    muddle, allows commands like "git clone" to do their progress report
-    "rolling" output. However, the warnings in the Python subprocess
+    Unlike the various 'runX' functions, if 'thing' is a string this calls
+    subprocess.Popen with 'shell=True'. This makes things like "cd" available
+    in 'thing', and use of shell specific things like value expansion. It
+    also, more importantly for muddle, allows commands like "git clone" to
+    do their progress report "rolling" output (which is also true when
+    'thing' is a sequence). However, the warnings in the Python subprocess
     documentation should be heeded about not using unsafe command lines.
 
     NB: If you *do* want to do "cd xxx; yyy", you're probably better doing::
@@ -654,18 +673,27 @@ def shell(thing, env=None, show_command=True):
         with Directory("xxx"):
             shell("yyy")
     """
-    if not isinstance(thing, basestring):
-        thing = _stringify_cmd(thing)
+    if isinstance(thing, basestring):
+        cmd = thing
+        use_shell = True
+    else:
+        cmd = _rationalise_cmd(thing)
+        use_shell = False
+        thing = _stringify_cmd(cmd)
     if show_command:
         sys.stdout.write('> %s\n'%thing)
     if env is None: # so, for instance, an empty dictionary is allowed
         env = os.environ
     try:
-        subprocess.check_call(thing, shell=True)
+        subprocess.check_call(cmd, shell=use_shell, env=env)
     except subprocess.CalledProcessError as e:
         # Unfortunately, e.output will actually be None, since it is only
         # populated for check_output.
         raise ShellError(thing, e.returncode, e.output)
+    except OSError as e:
+        # Without the shell, we find out ourselves if the command could not
+        # be run - report it as the shell would have done
+        raise ShellError(thing, 127, str(e))
 
 def get_cmd_data(thing, env=None, show_command=False):
     """Run the command 'thing', and return its output.
@@ -685,11 +713,7 @@ def get_cmd_data(thing, env=None, show_command=False):
 
     (This is basically a muddle-flavoured wrapper around subprocess.check_output)
     """
-    thing = _rationalise_cmd(thing)
-    if show_command:
-        sys.stdout.write('> %s\n'%_stringify_cmd(thing))
-    if env is None: # so, for instance, an empty dictionary is allowed
-        env = os.environ
+    thing, env = _prepare_cmd(thing, env, show_command)
     try:
         return subprocess.check_output(thing, env=env)
     except subprocess.CalledProcessError as e:
@@ -775,12 +799,7 @@ def run2(thing, env=None, show_command=True, show_output=False):
 
         (retcode, output)
     """
-    thing = _rationalise_cmd(thing)
-    if show_command:
-        sys.stdout.write('> %s\n'%_stringify_cmd(thing))
-        sys.stdout.flush()
-    if env is None: # so, for instance, an empty dictionary is allowed
-        env = os.environ
+    thing, env = _prepare_cmd(thing, env, show_command)
     text = []
     proc = subprocess.Popen(thing, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     for data in proc.stdout:
@@ -819,11 +838,7 @@ def run3(thing, env=None, show_command=True, show_output=False):
 
         (retcode, stdout, stderr)
     """
-    thing = _rationalise_cmd(thing)
-    if show_command:
-        sys.stdout.write('> %s\n'%_stringify_cmd(thing))
-    if env is None: # so, for instance, an empty dictionary is allowed
-        env = os.environ
+    thing, env = _prepare_cmd(thing, env, show_command)
     all_stdout_text = []
     all_stderr_text = []
     proc = subprocess.Popen(thing, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -907,12 +922,12 @@ def indent(text, indent):
     """Return the text indented with the 'indent' string.
 
     (i.e., place 'indent' in front of each line of text).
+
+        >>> print indent('one\\ntwo', '  ')
+          one
+          two
     """
-    lines = text.split('\n')
-    stuff = []
-    for line in lines:
-        stuff.append('%s%s'%(indent,line))
-    return '\n'.join(stuff)
+    return indent + text.replace('\n', '\n' + indent)
 
 def wrap(text, width=None, **kwargs):
     """A convenience wrapper around textwrap.wrap()
@@ -924,11 +939,21 @@ def wrap(text, width=None, **kwargs):
 
     return "\n".join(textwrap.wrap(text, width=width, **kwargs))
 
+gNumCols = None
+
 def num_cols():
     """How many columns on our terminal?
 
     If it can't tell (e.g., because it curses is not available), returns 70.
+
+    Setting up the terminal means reading the terminfo database, so once we
+    have found out, we remember the answer.
     """
+    global gNumCols
+
+    if gNumCols is not None:
+        return gNumCols
+
     if curses:
         try:
             curses.setupterm()
@@ -936,6 +961,7 @@ def num_cols():
             if cols <= 0:
                 return 70
             else:
+                gNumCols = cols
                 return cols
         except (TypeError, curses.error):
             # We get this if stdout not an int, or does not have a fileno()
@@ -975,18 +1001,24 @@ def truncate(text, columns=None, less=0):
     return text
 
 
+# How much of a file to read at a time when we're calculating its hash
+HASH_BUFSIZE=64*1024
+
 def dynamic_load(filename):
     try:
+        hasher = hashlib.md5()
         try:
             with open(filename, 'rb') as fin:
-                contents = fin.read()
+                while True:
+                    data = fin.read(HASH_BUFSIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
         except IOError as e:
             if e.errno == errno.ENOENT:
                 raise GiveUp('No such file: %s'%filename)
             else:
                 raise GiveUp('Cannot open file %s\n%s\n'%(filename, e))
-        hasher = hashlib.md5()
-        hasher.update(contents)
         md5_digest = hasher.hexdigest()
         return imp.load_source(md5_digest, filename)
     except GiveUp:
@@ -996,6 +1028,9 @@ def dynamic_load(filename):
                        "%s"%(filename, traceback.format_exc()))
 
 
+# The characters that maybe_shell_quote escapes
+_shell_escape_re = re.compile(r'([ "\'\\])')
+
 def do_shell_quote(str):
     return maybe_shell_quote(str, True)
 
@@ -1007,17 +1042,17 @@ def maybe_shell_quote(str, doQuote):
     quotes can (and will) be misinterpreted. Bah.
 
     NB: Despite the name, this is actually "escaping", rather then "quoting".
-    Specifically, any single quote, double quote or backslash characters in
-    the original string will be converted to a backslash followed by the
-    original character, in the final string.
+    Specifically, any single quote, double quote, backslash or space
+    characters in the original string will be converted to a backslash
+    followed by the original character, in the final string.
+
+        >>> print maybe_shell_quote('it\\'s a "test"\\\\', True)
+        it\\'s\\ a\\ \\"test\\"\\\\
+        >>> print maybe_shell_quote('a b', False)
+        a b
     """
     if doQuote:
-        result = []
-        for i in str:
-            if i=='"' or i=="\\" or i=="'" or i==" ":
-                result.append("\\")
-            result.append(i)
-        return "".join(result)
+        return _shell_escape_re.sub(r'\\\1', str)
     else:
         return str
 
@@ -1038,12 +1073,22 @@ def recursively_remove(a_dir):
     """
     Recursively demove a directory.
     """
-    if os.path.exists(a_dir):
-        # Again, the most efficient way to do this is to tell UNIX to do it
-        # for us.
-        run0("rm -rf \"%s\""%(a_dir))
+    try:
+        if os.path.islink(a_dir) or os.path.isfile(a_dir):
+            # Just like "rm -rf", remove a link, not what it refers to
+            os.remove(a_dir)
+        elif os.path.exists(a_dir):
+            shutil.rmtree(a_dir)
+    except OSError as e:
+        raise GiveUp('Unable to remove %s: %s'%(a_dir, e))
 
 
+# Which of the optional metadata functions this platform's os module provides
+_HAS_LCHMOD = hasattr(os, 'lchmod')
+_HAS_LCHFLAGS = hasattr(os, 'lchflags')
+_HAS_CHFLAGS = hasattr(os, 'chflags')
+_HAS_LCHOWN = hasattr(os, 'lchown')
+
 def copy_file_metadata(from_path, to_path):
     """
     Copy file metadata.
@@ -1061,25 +1106,57 @@ def copy_file_metadata(from_path, to_path):
     if os.path.islink(to_path):
         st = os.lstat(from_path)
 
-        if hasattr(os, 'lchmod'):
+        if _HAS_LCHMOD:
             mode = stat.S_IMODE(st.st_mode)
             os.lchmod(to_path, mode)
 
-        if hasattr(os, 'lchflags'):
+        if _HAS_LCHFLAGS:
             os.lchflags(to_path, st.st_flags)
 
-        if os.geteuid() == 0 and hasattr(os, 'lchown'):
+        if _HAS_LCHOWN and os.geteuid() == 0:
             os.lchown(to_path, st.st_uid, st.st_gid)
     else:
         st = os.stat(from_path)
         mode = stat.S_IMODE(st.st_mode)
         os.chmod(to_path, mode)
         os.utime(to_path, (st.st_atime, st.st_mtime))
-        if hasattr(os, 'chflags'):
+        if _HAS_CHFLAGS:
             os.chflags(to_path, st.st_flags)
         if os.geteuid() == 0:
             os.chown(to_path, st.st_uid, st.st_gid)
 
+# How much to read at a time when copying a file's contents
+COPY_BUFSIZE=1024*1024
+
+def _copy_file_contents(from_path, to_path):
+    """
+    Copy the contents of 'from_path' to 'to_path'.
+
+    This is just like shutil.copyfile(), except that it copies COPY_BUFSIZE
+    bytes at a time, rather than 16KiB, which means far fewer read and write
+    calls when copying large files. Like shutil.copyfile(), it raises
+    shutil.Error if the two paths are the same file, and
+    shutil.SpecialFileError if either is a named pipe.
+    """
+    if os.path.exists(to_path) and os.path.samefile(from_path, to_path):
+        raise shutil.Error("`%s` and `%s` are the same file"%(from_path, to_path))
+
+    # As shutil.copyfile does, refuse to copy to or from a named pipe, since
+    # opening it would wait (probably forever) for the other end
+    for path in (from_path, to_path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            # File most likely does not exist
+            pass
+        else:
+            if stat.S_ISFIFO(st.st_mode):
+                raise shutil.SpecialFileError("`%s` is a named pipe"%path)
+
+    with open(from_path, 'rb') as fsrc:
+        with open(to_path, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, COPY_BUFSIZE)
+
 def copy_file(from_path, to_path, object_exactly=False, preserve=False, force=False):
     """
     Copy a file (either a "proper" file, not a directory, or a symbolic link).
@@ -1110,11 +1187,11 @@ def copy_file(from_path, to_path, object_exactly=False, preserve=False, force=Fa
         os.symlink(linkto, to_path)
     else:
         try:
-            shutil.copyfile(from_path, to_path)
+            _copy_file_contents(from_path, to_path)
         except IOError as e:
             if force and e.errno == errno.EACCES:
                 os.remove(to_path)
-                shutil.copyfile(from_path, to_path)
+                _copy_file_contents(from_path, to_path)
             else:
                 raise
 
@@ -1148,8 +1225,7 @@ def split_path_left(in_path):
     Given a path ``a/b/c ...``, return a pair
     ``(a, b/c..)`` - ie. like ``os.path.split()``, but leftward.
 
-    What we actually do here is to split the path until we have
-    nothing left, then take the head and rest of the resulting list.
+    What we actually do here is to split the path at its first delimiter.
 
     For instance:
 
@@ -1191,59 +1267,43 @@ def split_path_left(in_path):
     # it leaves '//a/b/c' untouched
     in_path = os.path.normpath(in_path)
 
-    remains = in_path
-    lst = [ ]
-
-    while remains and remains not in ("/", "//"):
-        remains, end = os.path.split(remains)
-        lst.append(end)
-
-    if remains in ("/", "//"):
-        lst.append("")
-
-    # Our list is in reverse order, so ..
-    lst.reverse()
-
-    if False:
-        rp = lst[1]
-        for i in lst[2:]:
-            rp = os.path.join(rp, i)
-    else:
-        if len(lst) > 1:
-            rp = os.path.join(*lst[1:])
-        else:
-            rp = ""
-
-    return (lst[0], rp)
+    head, sep, rest = in_path.partition(os.sep)
+    # ...so we may need to remove a second leading delimiter ourselves
+    return (head, rest.lstrip(os.sep))
 
 
 def print_string_set(ss):
     """
     Given a string set, return a string representing it.
     """
-    result = [ ]
-    for s in ss:
-        result.append(s)
+    return " ".join(ss)
 
-    return " ".join(result)
+# The characters that c_escape escapes
+_c_escape_re = re.compile(r'([\r\n"\'\\])')
 
 def c_escape(v):
     """
     Escape sensitive characters in v.
     """
 
-    return re.sub(r'([\r\n"\'\\])', r'\\\1', v)
+    return _c_escape_re.sub(r'\\\1', v)
 
 def replace_root_name(base, replacement, filename):
     """
     Given a filename, a base and a replacement, replace base with replacement
     at the start of filename.
+
+        >>> replace_root_name('/a/b', '/c', '/a/b/d')
+        '/c/d'
+        >>> replace_root_name('/a/b', '/', '/a/b/d')
+        '/d'
+        >>> replace_root_name('/a/b', '/c', '/x/y')
+        '/x/y'
     """
     #print "replace_root_name %s, %s, %s"%(base,replacement, filename)
-    base_len = len(base)
-    if (filename.startswith(base)):
-        left = replacement + filename[base_len:]
-        if len(left) > 1 and left[:2] == '//':
+    if filename.startswith(base):
+        left = replacement + filename[len(base):]
+        if left.startswith('//'):
             left = left[1:]
         return left
     else:
@@ -1290,11 +1350,21 @@ def xml_elem_with_child(doc, elem_name, child_text):
     return el
 
 
-def _copy_without(src, dst, ignored_names, object_exactly, preserve, force):
+# The most threads that copy_without() will use to copy files. Copying a file
+# is mostly waiting on I/O, during which other threads can get on with copying
+# other files.
+COPY_THREADS = 8
+
+def _copy_without(src, dst, ignored_names, object_exactly, files, dirs):
     """
     The insides of copy_without. See that for more documentation.
 
     'ignored_names' must be a sequence of filenames to ignore (but may be empty).
+
+    Directories are created as we go, but files are not copied here. Instead,
+    a (srcname, dstname) tuple is appended to 'files' for each file (or link)
+    to be copied, and a (src, dst) tuple is appended to 'dirs' for each
+    directory, after those for any directories within it.
     """
 
     # Inspired by the example for shutil.copytree in the Python 2.6 documentation
@@ -1314,22 +1384,61 @@ def _copy_without(src, dst, ignored_names, object_exactly, preserve, force):
         srcname = os.path.join(src, name)
         dstname = os.path.join(dst, name)
         try:
-            if object_exactly and os.path.islink(srcname):
-                copy_file(srcname, dstname, object_exactly=True, preserve=preserve)
-            elif os.path.isdir(srcname):
-                _copy_without(srcname, dstname, ignored_names=ignored_names,
-                              object_exactly=object_exactly, preserve=preserve,
-                              force=force)
+            # A single lstat tells us if this is a link, and if not, whether
+            # it is a directory. We only need to stat a link's target if we
+            # are not copying it as a link.
+            mode = os.lstat(srcname).st_mode
+            if stat.S_ISLNK(mode):
+                is_dir = not object_exactly and os.path.isdir(srcname)
+            else:
+                is_dir = stat.S_ISDIR(mode)
+
+            if is_dir:
+                _copy_without(srcname, dstname, ignored_names, object_exactly,
+                              files, dirs)
             else:
-                copy_file(srcname, dstname, object_exactly=object_exactly,
-                          preserve=preserve, force=force)
+                files.append((srcname, dstname))
         except (IOError, os.error), why:
             raise GiveUp('Unable to copy %s to %s: %s'%(srcname, dstname, why))
 
+    dirs.append((src, dst))
+
+def _copy_one_file(args):
+    """
+    Copy a file for _copy_files, given (srcname, dstname, <copy_file args>)
+    """
+    srcname, dstname, object_exactly, preserve, force = args
     try:
-        copy_file_metadata(src, dst)
-    except OSError, why:
-        raise GiveUp('Unable to copy properties of %s to %s: %s'%(src, dst, why))
+        copy_file(srcname, dstname, object_exactly=object_exactly,
+                  preserve=preserve, force=force)
+    except (IOError, os.error), why:
+        raise GiveUp('Unable to copy %s to %s: %s'%(srcname, dstname, why))
+
+def _copy_files(jobs):
+    """
+    Call _copy_one_file on each of 'jobs', using up to COPY_THREADS threads.
+    """
+    if len(jobs) < 2 or COPY_THREADS < 2:
+        for job in jobs:
+            _copy_one_file(job)
+        return
+
+    # Most muddle commands never copy a tree, so only pay for importing
+    # multiprocessing when we do
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(min(COPY_THREADS, len(jobs)))
+    try:
+        # Waiting with a timeout (of a week) means that we can still be
+        # interrupted with ^C, which is not true of a plain get()
+        pool.map_async(_copy_one_file, jobs).get(7*24*60*60)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
 def copy_without(src, dst, without=None, object_exactly=True, preserve=False,
                  force=False, verbose=True):
@@ -1353,7 +1462,8 @@ def copy_without(src, dst, without=None, object_exactly=True, preserve=False,
 
     Creates directories in the destination, if necessary.
 
-    Uses copy_file() to copy each file.
+    Uses copy_file() to copy each file, with up to COPY_THREADS files being
+    copied at the same time.
     """
 
     if without is not None:
@@ -1367,7 +1477,20 @@ def copy_without(src, dst, without=None, object_exactly=True, preserve=False,
             print 'ignoring %s'%without
         print
 
-    _copy_without(src, dst, ignored_names, object_exactly, preserve, force)
+    files = []
+    dirs = []
+    _copy_without(src, dst, ignored_names, object_exactly, files, dirs)
+
+    _copy_files([(srcname, dstname, object_exactly, preserve, force)
+                 for srcname, dstname in files])
+
+    # Only now that all the files have been copied can we set each directory's
+    # timestamps. 'dirs' is in the right order for doing that.
+    for src_dir, dst_dir in dirs:
+        try:
+            copy_file_metadata(src_dir, dst_dir)
+        except OSError, why:
+            raise GiveUp('Unable to copy properties of %s to %s: %s'%(src_dir, dst_dir, why))
 
 def copy_name_list_with_dirs(file_list, old_root, new_root,
                              object_exactly = True, preserve = False):
@@ -1380,10 +1503,14 @@ def copy_name_list_with_dirs(file_list, old_root, new_root,
     old_root is the old root directory
     new_root is where we want them copied
     """
+    # Many files will share a directory, so only check each directory once
+    dirs_done = set()
     for f in file_list:
         tgt_name = replace_root_name(old_root, new_root, f)
         target_dir = os.path.dirname(tgt_name)
-        ensure_dir(target_dir)
+        if target_dir not in dirs_done:
+            ensure_dir(target_dir)
+            dirs_done.add(target_dir)
         copy_file(f, tgt_name, object_exactly, preserve)
 
 
@@ -1519,6 +1646,10 @@ def sort_domains(domains):
 
     return result
 
+# Remember the sub-paths we've already worked out, since the same few domain
+# names get asked for again and again
+gDomainSubpaths = {}
+
 def domain_subpath(domain_name):
     """Calculate the sub-path for a given domain name.
 
@@ -1539,12 +1670,19 @@ def domain_subpath(domain_name):
     if domain_name is None:
         return ''
 
+    try:
+        return gDomainSubpaths[domain_name]
+    except KeyError:
+        pass
+
     parts = []
     for thing in split_domain(domain_name):
         parts.append('domains')
         parts.append(thing)
 
-    return os.path.join(*parts)
+    subpath = os.path.join(*parts)
+    gDomainSubpaths[domain_name] = subpath
+    return subpath
 
 
 gArchName = None
@@ -1557,77 +1695,121 @@ def arch_name():
     global gArchName
 
     if (gArchName is None):
-        # This is what the docs say you should do. Ugh.
-        x = subprocess.Popen(["uname", "-m"], stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE).communicate()[0]
-        gArchName = x.strip()
+        # The same as "uname -m", but without running a process to find out
+        gArchName = os.uname()[4]
 
     return gArchName
 
 
-def unescape_backslashes(str):
-    """
-    Replace every string '\\X' with X, as if you were a shell
-    """
-
-    wasBackslash = False
-    result = [ ]
-    for i in str:
-        if (wasBackslash):
-            result.append(i)
-            wasBackslash = False
-        else:
-            if (i == '\\'):
-                wasBackslash = True
-            else:
-                result.append(i)
+# A backslash and the character it escapes (if any - a backslash at the very
+# end of a string escapes nothing)
+_backslash_escape_re = re.compile(r'\\(.?)', re.DOTALL)
 
-    return "".join(result)
+def unescape_backslashes(str):
+    r"""
+    Replace every string '\X' with X, as if you were a shell
 
+        >>> print unescape_backslashes(r'a\ b\\c\'d')
+        a b\c'd
+        >>> print unescape_backslashes('no escapes')
+        no escapes
+        >>> print unescape_backslashes('trailing\\')
+        trailing
+    """
+    if '\\' not in str:
+        return str
+    return _backslash_escape_re.sub(r'\1', str)
 
 
 def quote_list(lst):
-    """
+    r"""
     Given a list, quote each element of it and return them, space separated
+
+    Each element is escaped as by do_shell_quote(), so unquote_list() will
+    turn the result back into the original list:
+
+        >>> print quote_list(['-L/usr/lib', "it's", 'a b'])
+        -L/usr/lib it\'s a\ b
+        >>> unquote_list(quote_list(['-L/usr/lib', "it's", 'a b']))
+        ['-L/usr/lib', "it's", 'a b']
     """
-    return " ".join(map(do_shell_quote, lst))
+    return " ".join([_shell_escape_re.sub(r'\\\1', item) for item in lst])
 
 
 def unquote_list(lst):
-    """
+    r"""
     Given a list of objects, potentially enclosed in quotation marks or other
     shell weirdness, return a list of the actual objects.
-    """
 
-    # OK. First, dispose of any enclosing quotes.
-    result = [ ]
-    lst = lst.strip()
-    if (lst[0] == '\'' or lst[0] == "\""):
-        lst = lst[1:-1]
+    Any quotes around the whole list are removed, and then what is left is
+    split into words by shlex.split(), which follows the shell's rules for
+    quotes and backslashes. So words are separated by any whitespace, and
+    quotes within a word are removed, as the shell would:
 
-    initial = lst.split(' ')
-    last = None
+        >>> unquote_list("' -L/usr/lib /usr/lib/libz.la  -lm'")
+        ['-L/usr/lib', '/usr/lib/libz.la', '-lm']
+        >>> unquote_list(r'a\ b c\\d')
+        ['a b', 'c\\d']
+        >>> unquote_list('-DFOO="bar"\t-lm')
+        ['-DFOO=bar', '-lm']
+        >>> unquote_list("")
+        []
 
-    for i in initial:
-        if (last is not None):
-            last = last + i
-        else:
-            last = i
+    If it can't be split like that (for instance, because a quote is
+    not closed), we just split at whitespace and remove any backslashes,
+    leaving quotes alone:
 
-        # If last ended in a backslash, round again
-        if (len(last) > 0 and last[-1] == '\\'):
-            last = last[:-1]
-            continue
+        >>> unquote_list("-lm it's")
+        ['-lm', "it's"]
+    """
+    lst = lst.strip()
+    if lst[:1] in ('\'', '"'):
+        lst = lst[1:-1]
+    try:
+        return shlex.split(lst)
+    except ValueError:
+        return [unescape_backslashes(word) for word in lst.split()]
 
-        # Otherwise, dump it, unescaping everything else
-        # as we do so
-        result.append(unescape_backslashes(last))
-        last = None
+def _find_by_predicate_in(dir, accept_fn, links_are_symbolic, result):
+    """
+    The insides of find_by_predicate, for a 'dir' known to be a directory.
 
-    if (last is not None):
-        result.append(unescape_backslashes(last))
+    Appends the (not None) results for everything within 'dir' to 'result'.
+    """
+    # Rather than recursing, we keep a stack of the directories we are part
+    # way through, each with an iterator over the names still to look at.
+    # This visits everything in the same order that recursion would.
+    #
+    # Each directory is remembered as the prefix for its entries' paths
+    # (i.e., with a trailing separator), which saves us calling os.path.join
+    # for every entry.
+    stack = [(os.path.join(dir, ''), iter(os.listdir(dir)))]
+    while stack:
+        prefix, names = stack[-1]
+        for name in names:
+            full_name = prefix + name
+            r = accept_fn(full_name)
+            if (r is not None):
+                result.append(r)
 
-    return result
+            # A single lstat tells us if this is a directory, or a link that
+            # we may have to look through
+            mode = os.lstat(full_name).st_mode
+            if stat.S_ISDIR(mode):
+                is_dir = True
+            elif stat.S_ISLNK(mode):
+                is_dir = not links_are_symbolic and os.path.isdir(full_name)
+            else:
+                is_dir = False
+
+            # os.listdir() doesn't return . and ..
+            if is_dir:
+                # Look inside it before carrying on with this directory
+                stack.append((full_name + os.sep, iter(os.listdir(full_name))))
+                break
+        else:
+            # We've finished with this directory
+            stack.pop()
 
 def find_by_predicate(source_dir, accept_fn, links_are_symbolic = True):
     """
@@ -1635,6 +1817,10 @@ def find_by_predicate(source_dir, accept_fn, links_are_symbolic = True):
      fn(source_base, file_name) -> result
 
     Obtain a list of [result] if result is not None.
+
+    'accept_fn' is called once for 'source_dir' itself, and once for each
+    file, directory or link beneath it. If 'links_are_symbolic' is true,
+    then we do not look inside links to directories.
     """
 
     result = [ ]
@@ -1644,23 +1830,24 @@ def find_by_predicate(source_dir, accept_fn, links_are_symbolic = True):
         result.append(r)
 
 
-    if (links_are_symbolic and os.path.islink(source_dir)):
-        # Bah
+    # As below, one lstat tells us whether we need look any further
+    try:
+        mode = os.lstat(source_dir).st_mode
+    except OSError:
+        # It doesn't exist, so there's nothing inside it
         return result
 
-    if (os.path.isdir(source_dir)):
-        # We may need to recurse...
-        names = os.listdir(source_dir)
-
-        for name in names:
-            full_name = os.path.join(source_dir, name)
-            r = accept_fn(full_name)
-            if (r is not None):
-                result.append(r)
+    if stat.S_ISLNK(mode):
+        if links_are_symbolic:
+            # Bah
+            return result
+        is_dir = os.path.isdir(source_dir)
+    else:
+        is_dir = stat.S_ISDIR(mode)
 
-            # os.listdir() doesn't return . and ..
-            if (os.path.isdir(full_name)):
-                result.extend(find_by_predicate(full_name, accept_fn, links_are_symbolic))
+    if is_dir:
+        # We may need to recurse...
+        _find_by_predicate_in(source_dir, accept_fn, links_are_symbolic, result)
 
     return result
 
@@ -1724,13 +1911,31 @@ class MuddleOrderedDict(MutableMapping):
     def __iter__(self):
         return iter(self._keys)
 
+# Files at least this big are memory mapped by calc_file_hash, rather than read
+HASH_MMAP_SIZE=1024*1024
+
 def calc_file_hash(filename):
     """Calculate and return the SHA1 hash for the named file.
-    """
-    with HashFile(filename) as fd:
-        for line in fd:
-            pass
-    return fd.hash()
+
+    Files of HASH_MMAP_SIZE bytes or more are memory mapped, and hashed in
+    one go. Smaller files are read in binary mode, HASH_BUFSIZE bytes at a
+    time - there is no need to split them into lines just to hash them.
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size >= HASH_MMAP_SIZE:
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                sha.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            while True:
+                data = fd.read(HASH_BUFSIZE)
+                if not data:
+                    break
+                sha.update(data)
+    return sha.hexdigest()
 
 class HashFile(object):
     """
@@ -1768,8 +1973,12 @@ class HashFile(object):
         self.mode = mode
         self.ignore_comments = ignore_comments
         self.ignore_blank_lines = ignore_blank_lines
-        self.fd = open(name, mode)
+        # Use binary mode, so that what we hash is exactly what is in the file
+        self.fd = open(name, mode + 'b')
         self.sha = hashlib.sha1()
+        # Text written but not yet added to the hash, and its total length
+        self._unhashed = []
+        self._unhashed_len = 0
 
     def _add_to_hash(self, text):
         """Should we add this line of text to our hash calculation?
@@ -1797,8 +2006,21 @@ class HashFile(object):
             raise MuddleBug("Cannot write to HashFile '%s', opened for read"%self.name)
         self.fd.write(text)
 
+        # Lines tend to be short, so it is much cheaper to collect them up
+        # and add them to the hash HASH_BUFSIZE or so at a time
         if self._add_to_hash(text):
-            self.sha.update(text)
+            self._unhashed.append(text)
+            self._unhashed_len += len(text)
+            if self._unhashed_len >= HASH_BUFSIZE:
+                self._update_hash()
+
+    def _update_hash(self):
+        """Add any text written but not yet hashed to the hash.
+        """
+        if self._unhashed:
+            self.sha.update(''.join(self._unhashed))
+            self._unhashed = []
+            self._unhashed_len = 0
 
     def readline(self):
         """
@@ -1821,6 +2043,7 @@ class HashFile(object):
         """
         Return the SHA1 hash, calculated from the lines so far, as a hex string.
         """
+        self._update_hash()
         return self.sha.hexdigest()
 
     def close(self):
@@ -2230,12 +2453,14 @@ def debian_version_is(test, ref):
     return 0;
 
 
+_debian_version_re = re.compile(r'([0-9]+)\.([0-9]+)(\.[0-9])?(-([0-9]+)(.*)$)?')
+
 def split_debian_version(v):
     """
     Takes a debian-style version string - <major>.<minor>.<subminor>-<issue><additional> - and
     turns it into a dictionary with those keys.
      """
-    m = re.match(r'([0-9]+)\.([0-9]+)(\.[0-9])?(-([0-9]+)(.*)$)?', v)
+    m = _debian_version_re.match(v)
     if (m is None):
         raise GiveUp("'%s' is not a legal debian version"%v)
     grps = m.groups()
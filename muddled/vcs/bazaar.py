@@ -39,6 +39,9 @@ import re
 from muddled.version_control import register_vcs, VersionControlSystem
 import muddled.utils as utils
 
+# The warning bzr gives if it couldn't load its compiled extensions
+_compiled_extensions_re = re.compile(".*some compiled extensions")
+
 class Bazaar(VersionControlSystem):
     """
     Provide version control operations for Bazaar
@@ -81,9 +84,8 @@ class Bazaar(VersionControlSystem):
         # match.
         lines = in_str.split('\n')
         rv = [ ]
-        my_re = re.compile(".*some compiled extensions")
         for l in lines:
-            if (not my_re.match(l)):
+            if (not _compiled_extensions_re.match(l)):
                 rv.append(l)
         out_str = "\n".join(rv)
         return out_str
@@ -101,15 +103,15 @@ class Bazaar(VersionControlSystem):
 
     def _r_option(self, revision):
         """
-        Return the -r option(s) to pass to bzr commands, if any
+        Return a list of the -r option(s) to pass to bzr commands, if any
         """
         if revision is None or revision == "HEAD":
-            return ""
+            return []
         else:
             # We can't says "-r revno:xxx" because we don't know what the
             # user has given us, and it may not be a revno (indeed, they
             # could have given us "date:yesterday"
-            return "-r %s"%revision
+            return ["-r", revision]
 
     def _derive_env(self):
         """
@@ -142,7 +144,7 @@ class Bazaar(VersionControlSystem):
         """
         # This is *really* hacky...
         if not os.path.exists('.bzr'):
-            utils.shell("bzr init", env=self._derive_env(), show_command=verbose)
+            utils.shell(["bzr", "init"], env=self._derive_env(), show_command=verbose)
 
     def add_files(self, files=None, verbose=True):
         """
@@ -151,7 +153,7 @@ class Bazaar(VersionControlSystem):
         Will be called in the actual checkout's directory.
         """
         if files:
-            utils.shell("bzr add %s"%' '.join(files))
+            utils.shell(["bzr", "add"] + list(files))
 
     def checkout(self, repo, co_leaf, options, verbose=True):
         """
@@ -169,10 +171,9 @@ class Bazaar(VersionControlSystem):
         if repo.branch:
             raise utils.GiveUp("Bazaar does not support branch (in the muddle sense)"
                                " in 'checkout' (branch='%s')"%repo.branch)
-        utils.shell("bzr branch %s %s %s"%(self._r_option(repo.revision),
-                                          self._normalised_repo(repo.url),
-                                          co_leaf),
-                   env=self._derive_env(), show_command=verbose)
+        utils.shell(["bzr", "branch"] + self._r_option(repo.revision) +
+                    [self._normalised_repo(repo.url), co_leaf],
+                    env=self._derive_env(), show_command=verbose)
 
     def _is_it_safe(self, env):
         """
@@ -202,7 +203,7 @@ class Bazaar(VersionControlSystem):
 
         starting_revno = self._just_revno()
 
-        text = self._run1("bzr pull %s %s"%(rspec, self._normalised_repo(repo.url)),
+        text = self._run1(["bzr", "pull"] + rspec + [self._normalised_repo(repo.url)],
                           env=env, verbose=verbose)
         print text
         if (text.startswith('No revisions to pull')  # older versions of bzr
@@ -214,21 +215,21 @@ class Bazaar(VersionControlSystem):
             # First we 'uncommit' to take our history back. The --force answers
             # 'yes' to all questions (otherwise the user would be prompted as
             # to whether they really wanted to do this operation
-            retcode, text = self._run2("bzr uncommit --force --quiet %s"%rspec,
+            retcode, text = self._run2(["bzr", "uncommit", "--force", "--quiet"] + rspec,
                                        env=env, verbose=verbose)
             if retcode:
                 raise utils.GiveUp('Error uncommiting to revision %s (we already tried'
-                                   ' pull)\nReturn code  %d\n%s'%(rspec, retcode, text))
+                                   ' pull)\nReturn code  %d\n%s'%(repo.revision, retcode, text))
             print text
             # Then we need to 'revert' to undo any changes (since uncommit
             # doesn't change our working set). The --no-backup stops us
             # being left with copies of the changes in backup files (which
             # is exactly what we don't want)
-            retcode, text = self._run2("bzr revert --no-backup %s"%rspec,
+            retcode, text = self._run2(["bzr", "revert", "--no-backup"] + rspec,
                                        env=env, verbose=verbose)
             if retcode:
                 raise utils.GiveUp('Error reverting to revision %s (we already'
-                                   ' uncommitted)\nReturn code %d\n%s'%(rspec, retcode, text))
+                                   ' uncommitted)\nReturn code %d\n%s'%(repo.revision, retcode, text))
             print text
 
         ending_revno = self._just_revno()
@@ -256,8 +257,8 @@ class Bazaar(VersionControlSystem):
 
         starting_revno = self._just_revno()
 
-        utils.shell("bzr merge %s %s"%(rspec, self._normalised_repo(other_repo.url)),
-                   env=env, show_command=verbose)
+        utils.shell(["bzr", "merge"] + rspec + [self._normalised_repo(other_repo.url)],
+                    env=env, show_command=verbose)
 
         ending_revno = self._just_revno()
         # Did we update anything?
@@ -269,16 +270,20 @@ class Bazaar(VersionControlSystem):
         """
         # Options: --strict means it will not commit if there are unknown
         # files in the working tree
-        utils.shell("bzr commit", allowFailure=True,
-                   env=self._derive_env(), show_command=verbose)
+        try:
+            utils.shell(["bzr", "commit"],
+                        env=self._derive_env(), show_command=verbose)
+        except utils.ShellError:
+            # For instance, there was nothing to commit
+            pass
 
     def push(self, repo, options, upstream=None, verbose=True):
         """
         Will be called in the actual checkout's directory.
         """
 
-        utils.shell("bzr push %s"%self._normalised_repo(repo.url),
-                   env=self._derive_env(), show_command=verbose)
+        utils.shell(["bzr", "push", self._normalised_repo(repo.url)],
+                    env=self._derive_env(), show_command=verbose)
 
     def status(self, repo, options=None, branch=None, verbose=False, quick=False):
         """
@@ -293,7 +298,8 @@ class Bazaar(VersionControlSystem):
             return "muddle status -quick is not supported on bzr checkouts"
 
         # --quiet means only report warnings and errors
-        cmd = 'bzr status --quiet -r branch:%s'%self._normalised_repo(repo.url),
+        cmd = ['bzr', 'status', '--quiet', '-r',
+               'branch:%s'%self._normalised_repo(repo.url)]
 
         text = self._run1(cmd, env=env, fold_stderr=False)
         if text:
@@ -0,0 +1,393 @@
+#! /usr/bin/env python
+"""Test how aptget decides which OS packages to install, and when.
+
+We don't want to install anything for real, so we put our own "sudo" and
+"dpkg-query" scripts at the front of the PATH. The "sudo" script remembers
+what it was asked to do, and fails if it is asked to install the package
+named in its "fail" file.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import unittest
+
+from support_for_tests import *
+
+import muddled.pkgs.aptget as aptget
+from muddled.depend import Action, Label, Rule
+from muddled.mechanics import minimal_build_tree
+from muddled.utils import GiveUp, LabelTag, LabelType
+
+SUDO = """\
+#! /bin/sh
+printf '%%s\\n' "$*" >> "%s"
+fail=`cat "%s"`
+for arg in "$@"
+do
+    if [ "$arg" = "$fail" ]
+    then
+        exit 100
+    fi
+done
+exit 0
+"""
+
+DPKG_QUERY = """\
+#! /bin/sh
+printf '%%s\\n' "$*" >> "%s"
+cat "%s"
+"""
+
+class AptGetTestCase(unittest.TestCase):
+    """Gives each test a build tree, and fake "sudo" and "dpkg-query".
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_path = os.environ['PATH']
+
+        bin_dir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bin_dir)
+        self.sudo_log = os.path.join(self.tmpdir, 'sudo.log')
+        self.sudo_fail = os.path.join(self.tmpdir, 'fail')
+        self.dpkg_log = os.path.join(self.tmpdir, 'dpkg-query.log')
+        self.dpkg_installed = os.path.join(self.tmpdir, 'installed')
+        self.set_installed([])
+        self.set_failing('')
+        self.write_script(os.path.join(bin_dir, 'sudo'),
+                          SUDO%(self.sudo_log, self.sudo_fail))
+        self.write_script(os.path.join(bin_dir, 'dpkg-query'),
+                          DPKG_QUERY%(self.dpkg_log, self.dpkg_installed))
+        os.environ['PATH'] = os.pathsep.join([bin_dir, self.old_path])
+
+        root_dir = os.path.join(self.tmpdir, 'tree')
+        os.mkdir(root_dir)
+        self.builder = minimal_build_tree('muddle', root_dir,
+                                          'git+file:///nowhere',
+                                          'builds/01.py')
+        aptget.g_installed_packages = None
+
+    def tearDown(self):
+        aptget.g_installed_packages = None
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.tmpdir)
+
+    def write_script(self, path, text):
+        with open(path, 'w') as fd:
+            fd.write(text)
+        os.chmod(path, 0755)
+
+    def set_installed(self, names):
+        """Set what our "dpkg-query" says is installed.
+
+        A name like 'libc6:i386' is a package for another architecture,
+        anything else is for amd64.
+        """
+        with open(self.dpkg_installed, 'w') as fd:
+            for name in names:
+                if ':' in name:
+                    bare, arch = name.split(':')
+                else:
+                    bare, arch = name, 'amd64'
+                fd.write('ii  %s %s %s\n'%(bare, name, arch))
+
+    def installed(self, names):
+        """The set of names we expect for the packages set_installed(names).
+        """
+        result = set()
+        for name in names:
+            bare = name.split(':')[0]
+            if ':' not in name:
+                name = '%s:amd64'%name
+            result.update([bare, name])
+        return result
+
+    def set_failing(self, name):
+        """Make our "sudo" fail if it is asked to install 'name'.
+
+        (We can't use an environment variable for this, because building
+        a label replaces os.environ with a plain dictionary.)
+        """
+        with open(self.sudo_fail, 'w') as fd:
+            fd.write('%s\n'%name)
+
+    def add_aptget(self, name, role, apt_pkgs):
+        """Add an apt-get package, and return the rule for building it.
+        """
+        aptget.simple(self.builder, name, role, apt_pkgs)
+        label = Label(LabelType.Package, name, role, LabelTag.Built)
+        return self.builder.ruleset.rule_for_target(label)
+
+    def apt_get_calls(self):
+        """Return the (sorted) lists of packages "sudo" was asked to install.
+        """
+        if not os.path.exists(self.sudo_log):
+            return []
+        calls = []
+        with open(self.sudo_log) as fd:
+            for line in fd:
+                words = line.split()
+                self.assertEqual(words[:2], ['apt-get', 'install'])
+                words = words[2:]
+                pkgs = []
+                while words:
+                    word = words.pop(0)
+                    if word == '-o':
+                        words.pop(0)
+                    elif not word.startswith('-'):
+                        pkgs.append(word)
+                calls.append(sorted(pkgs))
+        return calls
+
+
+class TestBatching(AptGetTestCase):
+
+    def test_only_rules_being_built_contribute(self):
+        r1 = self.add_aptget('first', 'x', ['libfirst', 'libboth'])
+        self.add_aptget('second', 'x', ['libsecond'])
+        r3 = self.add_aptget('third', 'y', ['libthird', 'libboth'])
+        self.builder.rules_being_built = [r1, r3]
+        r1.action.build_label(self.builder, r1.target)
+        self.assertEqual(self.apt_get_calls(),
+                         [['libboth', 'libfirst', 'libthird']])
+
+    def test_installed_packages_are_not_batched(self):
+        self.set_installed(['libboth'])
+        r1 = self.add_aptget('first', 'x', ['libfirst', 'libboth'])
+        r2 = self.add_aptget('second', 'x', ['libsecond', 'libboth'])
+        self.builder.rules_being_built = [r1, r2]
+        r1.action.build_label(self.builder, r1.target)
+        # And now the second package has nothing left to do
+        r2.action.build_label(self.builder, r2.target)
+        self.assertEqual(self.apt_get_calls(), [['libfirst', 'libsecond']])
+
+    def test_failing_extra_package_falls_back(self):
+        self.set_failing('libsecond')
+        r1 = self.add_aptget('first', 'x', ['libfirst'])
+        r2 = self.add_aptget('second', 'x', ['libsecond'])
+        self.builder.rules_being_built = [r1, r2]
+        r1.action.build_label(self.builder, r1.target)
+        self.assertEqual(self.apt_get_calls(),
+                         [['libfirst', 'libsecond'], ['libfirst']])
+        self.assertTrue('libfirst' in aptget.installed_packages())
+        self.assertFalse('libsecond' in aptget.installed_packages())
+
+    def test_failing_own_package_gives_up(self):
+        self.set_failing('libfirst')
+        r1 = self.add_aptget('first', 'x', ['libfirst'])
+        r2 = self.add_aptget('second', 'x', ['libsecond'])
+        self.builder.rules_being_built = [r1, r2]
+        with self.assertRaises(GiveUp):
+            r1.action.build_label(self.builder, r1.target)
+        self.assertEqual(self.apt_get_calls(),
+                         [['libfirst', 'libsecond'], ['libfirst']])
+
+    def test_failing_own_package_alone_gives_up(self):
+        self.set_failing('libfirst')
+        r1 = self.add_aptget('first', 'x', ['libfirst'])
+        self.builder.rules_being_built = [r1]
+        with self.assertRaises(GiveUp):
+            r1.action.build_label(self.builder, r1.target)
+        self.assertEqual(self.apt_get_calls(), [['libfirst']])
+
+    def test_build_label_batches(self):
+        r1 = self.add_aptget('first', 'x', ['libfirst'])
+        r2 = self.add_aptget('second', 'x', ['libsecond'])
+        everything = Label(LabelType.Package, 'everything', 'x',
+                           LabelTag.Built)
+        rule = Rule(everything, None)
+        rule.add(r1.target)
+        rule.add(r2.target)
+        self.builder.ruleset.add(rule)
+        self.builder.build_label(everything, silent=True)
+        self.assertEqual(self.apt_get_calls(), [['libfirst', 'libsecond']])
+        self.assertEqual(self.builder.rules_being_built, [])
+
+
+class TestInstalledPackages(AptGetTestCase):
+
+    def test_bare_and_qualified_names(self):
+        self.set_installed(['libfirst', 'libc6:i386'])
+        self.assertEqual(aptget.installed_packages(),
+                         set(['libfirst', 'libfirst:amd64',
+                              'libc6', 'libc6:i386']))
+
+    def test_not_installed(self):
+        with open(self.dpkg_installed, 'w') as fd:
+            fd.write('ii  libfirst libfirst amd64\n'
+                     'un  libsecond libsecond \n'
+                     'rc  libthird libthird amd64\n')
+        self.assertEqual(aptget.installed_packages(),
+                         set(['libfirst', 'libfirst:amd64']))
+
+    def test_multiarch_package_is_not_reinstalled(self):
+        self.set_installed(['libc6-dev:i386'])
+        r1 = self.add_aptget('first', 'x', ['libc6-dev:i386'])
+        self.builder.rules_being_built = [r1]
+        r1.action.build_label(self.builder, r1.target)
+        self.assertEqual(self.apt_get_calls(), [])
+
+
+class TestInstalledCache(AptGetTestCase):
+    """Test remembering the installed packages in the .muddle directory.
+    """
+
+    def setUp(self):
+        AptGetTestCase.setUp(self)
+        self.old_status_file = aptget.DPKG_STATUS_FILE
+        aptget.DPKG_STATUS_FILE = os.path.join(self.tmpdir, 'status')
+        with open(aptget.DPKG_STATUS_FILE, 'w') as fd:
+            fd.write('Package: libfirst\n')
+        self.cache_file = self.builder.db.db_file_name('_aptget_installed')
+
+    def tearDown(self):
+        aptget.DPKG_STATUS_FILE = self.old_status_file
+        AptGetTestCase.tearDown(self)
+
+    def dpkg_query_calls(self):
+        if not os.path.exists(self.dpkg_log):
+            return 0
+        with open(self.dpkg_log) as fd:
+            return len(fd.readlines())
+
+    def installed_packages(self):
+        """As if this were the first time in a new muddle command.
+        """
+        aptget.g_installed_packages = None
+        return aptget.installed_packages(self.builder)
+
+    def test_cache_hit_skips_query(self):
+        self.set_installed(['libfirst'])
+        self.assertEqual(self.installed_packages(), self.installed(['libfirst']))
+        self.assertEqual(self.dpkg_query_calls(), 1)
+        # If we ran dpkg-query again, we'd notice this
+        self.set_installed(['libsecond'])
+        self.assertEqual(self.installed_packages(), self.installed(['libfirst']))
+        self.assertEqual(self.dpkg_query_calls(), 1)
+
+    def test_key_mismatch_queries_again(self):
+        self.set_installed(['libfirst'])
+        self.assertEqual(self.installed_packages(), self.installed(['libfirst']))
+        # Pretend dpkg has installed something else
+        with open(aptget.DPKG_STATUS_FILE, 'a') as fd:
+            fd.write('Package: libsecond\n')
+        self.set_installed(['libfirst', 'libsecond'])
+        self.assertEqual(self.installed_packages(),
+                         self.installed(['libfirst', 'libsecond']))
+        self.assertEqual(self.dpkg_query_calls(), 2)
+        with open(self.cache_file) as fd:
+            lines = fd.read().splitlines()
+        self.assertEqual(lines[0], aptget._dpkg_status_key())
+        self.assertEqual(set(lines[1:]),
+                         self.installed(['libfirst', 'libsecond']))
+        # And the rewritten cache is used next time
+        self.assertEqual(self.installed_packages(),
+                         self.installed(['libfirst', 'libsecond']))
+        self.assertEqual(self.dpkg_query_calls(), 2)
+
+    def test_unwritable_muddle_dir_is_ignored(self):
+        self.set_installed(['libfirst'])
+        muddle_dir = os.path.dirname(self.cache_file)
+        # If we're root, we can write to the directory whatever its
+        # permissions, so also put a directory where the file we write
+        # would go
+        os.mkdir('%s.new'%self.cache_file)
+        os.chmod(muddle_dir, 0555)
+        try:
+            self.assertEqual(self.installed_packages(), self.installed(['libfirst']))
+            self.assertEqual(self.installed_packages(), self.installed(['libfirst']))
+        finally:
+            os.chmod(muddle_dir, 0755)
+        self.assertFalse(os.path.exists(self.cache_file))
+        self.assertEqual(self.dpkg_query_calls(), 2)
+
+    def test_missing_status_file_disables_cache(self):
+        os.remove(aptget.DPKG_STATUS_FILE)
+        self.set_installed(['libfirst'])
+        self.assertEqual(self.installed_packages(), self.installed(['libfirst']))
+        self.assertEqual(self.installed_packages(), self.installed(['libfirst']))
+        self.assertFalse(os.path.exists(self.cache_file))
+        self.assertEqual(self.dpkg_query_calls(), 2)
+
+
+class RememberRules(Action):
+    """Remember what the builder is building, and maybe build something else.
+    """
+
+    def __init__(self, seen, inner=None):
+        self.seen = seen
+        self.inner = inner
+
+    def build_label(self, builder, label):
+        self.seen.append((label.name, 'before', list(builder.rules_being_built)))
+        if self.inner:
+            builder.build_label(self.inner, silent=True)
+        self.seen.append((label.name, 'after', list(builder.rules_being_built)))
+
+
+class TestRulesBeingBuilt(AptGetTestCase):
+
+    def test_nested_build_label_restores_rules(self):
+        seen = []
+        inner = Label(LabelType.Package, 'inner', 'x', LabelTag.Built)
+        outer = Label(LabelType.Package, 'outer', 'x', LabelTag.Built)
+        inner_rule = Rule(inner, RememberRules(seen))
+        outer_rule = Rule(outer, RememberRules(seen, inner))
+        self.builder.ruleset.add(inner_rule)
+        self.builder.ruleset.add(outer_rule)
+
+        self.builder.build_label(outer, silent=True)
+
+        self.assertEqual(seen,
+                         [('outer', 'before', [outer_rule]),
+                          ('inner', 'before', [inner_rule]),
+                          ('inner', 'after', [inner_rule]),
+                          ('outer', 'after', [outer_rule])])
+        self.assertEqual(self.builder.rules_being_built, [])
+
+    def test_rules_restored_after_failure(self):
+        self.set_failing('libfirst')
+        r1 = self.add_aptget('first', 'x', ['libfirst'])
+        with self.assertRaises(GiveUp):
+            self.builder.build_label(r1.target, silent=True)
+        self.assertEqual(self.builder.rules_being_built, [])
+
+
+def main(args):
+
+    if args:
+        print __doc__
+        raise GiveUp('Unexpected arguments %s'%' '.join(args))
+
+    print 'Testing aptget'
+
+    ok = True
+    for test_case in (TestBatching, TestInstalledPackages,
+                      TestInstalledCache, TestRulesBeingBuilt):
+        suite = unittest.TestLoader().loadTestsFromTestCase(test_case)
+        results = unittest.TextTestRunner().run(suite)
+        if not results.wasSuccessful():
+            ok = False
+
+    return ok
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    try:
+        ok = main(args)
+    except Exception as e:
+        print
+        traceback.print_exc()
+        ok = False
+
+    if ok:
+        print '\nGREEN light\n'
+    else:
+        print '\nRED light\n'
+        sys.exit(1)
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
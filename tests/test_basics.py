@@ -4,8 +4,10 @@ Tests the rest of muddled.
 """
 
 import os
+import shutil
 import sys
 import subprocess
+import tempfile
 import traceback
 
 from support_for_tests import get_parent_dir
@@ -278,6 +280,33 @@ def utils_unit_test():
     assert s == "/d/e"
 
 
+def copy_unit_test():
+    """
+    Unit testing on copying files and directory trees.
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmpdir, 'src')
+        dst = os.path.join(tmpdir, 'dst')
+        os.makedirs(os.path.join(src, 'sub'))
+        with open(os.path.join(src, 'sub', 'file'), 'w') as fd:
+            fd.write('Some text\n')
+        utils.copy_without(src, dst, verbose=False)
+        with open(os.path.join(dst, 'sub', 'file')) as fd:
+            assert fd.read() == 'Some text\n'
+
+        # Copying a named pipe should fail, rather than waiting forever for
+        # someone to write to it
+        os.mkfifo(os.path.join(src, 'sub', 'pipe'))
+        try:
+            utils.copy_without(src, dst, verbose=False)
+        except shutil.SpecialFileError as e:
+            assert 'is a named pipe' in str(e)
+        else:
+            assert False, 'Copying a named pipe did not fail'
+    finally:
+        shutil.rmtree(tmpdir)
+
 def vcs_unit_test():
     """
     Perform VCS unit tests.
@@ -450,6 +479,8 @@ def run_tests():
     cpio_unit_test()
     print "> Utils"
     utils_unit_test()
+    print "> Copying"
+    copy_unit_test()
     print "> env"
     env_store_unit_test()
     print "> subst"